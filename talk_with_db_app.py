@@ -1,18 +1,46 @@
 import streamlit as st
 import os
+import atexit
+import hashlib
+import pathlib
 import tempfile
 import sqlite3
 import pandas as pd
 import re
+import time
+import threading
+import weakref
+from contextlib import contextmanager
 from agno.agent import Agent
 from agno.tools.sql import SQLTools
 from agno.models.groq import Groq
+from agno.run.agent import RunOutput
 from dotenv import load_dotenv
+from sqlalchemy import create_engine
 
 # Load environment variables
 load_dotenv()
 groq_api_key = os.getenv("GROQ_API_KEY")
 
+# Number of user/assistant turns kept in the chat history
+MAX_TURNS = 20
+
+# Queued questions answered by a single agent run, and the line separating their answers
+MAX_BATCH_SIZE = 5
+BATCH_DELIMITER = "----- next answer -----"
+
+# Minimum seconds between plain-text refreshes of an in-flight response
+STREAM_REFRESH_INTERVAL = 0.05
+
+# SQLite's default limit on terms in a compound SELECT (SQLITE_MAX_COMPOUND_SELECT)
+MAX_COMPOUND_SELECT = 500
+
+# WITHOUT ROWID clause in a CREATE TABLE statement, however it is spaced
+WITHOUT_ROWID = re.compile(r'\bWITHOUT\s+ROWID\b', re.IGNORECASE)
+
+# ANSI color/control escape sequences emitted by agent debug formatting
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
 # Page configuration
 st.set_page_config(
     page_title="Talk with your DB",
@@ -21,27 +49,24 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def get_agent_response(query, db_path):
-    """Modified version of the original function to work with uploaded files"""
-    # First, get table information to provide context
-    table_info = explore_database(db_path)
-    table_names = list(table_info.keys())
+def build_system_message(table_info):
+    """Build the agent system message from the database structure"""
+    table_names = ', '.join(table_info.keys())
+    table_details = "\n".join(
+        f"- {table_name}: columns = {', '.join(col[1] for col in info['columns'])}"  # Column names
+        for table_name, info in table_info.items()
+    )
     
     # Create enhanced system message with table context
-    system_message = f"""
+    return f"""
     You are a helpful assistant that translates natural language to SQL queries for a SQLite database.
     
     IMPORTANT DATABASE CONTEXT:
-    Available tables: {', '.join(table_names)}
+    Available tables: {table_names}
     
     Table details:
-    """
     
-    for table_name, info in table_info.items():
-        columns = [col[1] for col in info['columns']]  # Get column names
-        system_message += f"\n- {table_name}: columns = {', '.join(columns)}"
-    
-    system_message += """
+{table_details}
     
     IMPORTANT RULES:
     - Use the EXACT table names and column names as provided above
@@ -50,70 +75,279 @@ def get_agent_response(query, db_path):
     - First use list_tables() to confirm available tables if unsure
     - Provide clear, well-formatted responses with explanations when appropriate
     """
-    
-    agent = Agent(
+
+@st.cache_resource
+def get_groq():
+    """Shared Groq model client, created once per process"""
+    return Groq(id="qwen/qwen3-32b", api_key=groq_api_key)  # Changed model
+
+def build_agent(db_path, system_message):
+    """Build a per-session SQL agent; only the model and engine are shared across sessions"""
+    return Agent(
         name="SQLite Agent",
-        model=Groq(id="qwen/qwen3-32b", api_key=groq_api_key),  # Changed model
+        model=get_groq(),
         markdown=True,
         system_message=system_message,
-        tools=[SQLTools(db_url=f'sqlite:///{db_path}')],
+        tools=[SQLTools(db_engine=get_engine(db_path))],
         retries=3,
         reasoning=False,  # Disabled reasoning to avoid JSON mode issues
     )
+
+def clean_response(text):
+    """Strip ANSI color codes and surrounding whitespace from agent output"""
+    # Remove ANSI color codes and formatting (skip the scan when no ESC byte is present)
+    if '\x1b' in text:
+        text = ANSI_ESCAPE.sub('', text)
     
+    # Remove extra whitespace and clean up
+    return text.strip()
+
+def stream_agent_response(query, agent):
+    """Yield the agent's response content as it is generated and return the final content"""
     # Get the agent's response without printing debug info
     try:
-        response = agent.run(query)
-        # Extract just the main response content, removing debug formatting
-        if hasattr(response, 'content'):
-            clean_response = response.content
-        else:
-            clean_response = str(response)
-        
-        # Remove ANSI color codes and formatting
-        import re
-        ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-        clean_response = ansi_escape.sub('', clean_response)
-        
-        # Remove extra whitespace and clean up
-        clean_response = clean_response.strip()
-        
-        return clean_response
+        for chunk in agent.run(query, stream=True, yield_run_output=True):
+            # A retried attempt re-streams its deltas from the start, so the settled
+            # text comes from the final RunOutput rather than the deltas
+            if isinstance(chunk, RunOutput):
+                return chunk.content if isinstance(chunk.content, str) else None
+            
+            # Only forward content deltas, skipping tool/run lifecycle events
+            content = getattr(chunk, 'content', None)
+            if isinstance(content, str) and content:
+                yield content
     except Exception as e:
-        return f"Error processing query: {str(e)}"
+        error = f"Error processing query: {str(e)}"
+        yield error
+        return error
+
+def render_stream(chunks):
+    """Show streamed chunks as plain text in a placeholder; return it with the final text"""
+    placeholder = st.empty()
+    buffer = []
+    last_refresh = 0.0
+    chunks = iter(chunks)
+    try:
+        # The agent runs its tool calls before the first content delta, so keep a
+        # spinner up until that delta arrives
+        with st.spinner("Analyzing your query..."):
+            buffer.append(next(chunks))
+        placeholder.text(buffer[0])
+        last_refresh = time.monotonic()
+        
+        while True:
+            buffer.append(next(chunks))
+            # Skip markdown parsing while streaming and throttle refreshes
+            now = time.monotonic()
+            if now - last_refresh >= STREAM_REFRESH_INTERVAL:
+                placeholder.text(''.join(buffer))
+                last_refresh = now
+    except StopIteration as stop:
+        # Prefer the generator's final text over the concatenated deltas
+        final = stop.value
+    return placeholder, final if final is not None else ''.join(buffer)
+
+def quote_identifier(name):
+    """Quote a table or column name for safe use in SQLite statements"""
+    return '"' + name.replace('"', '""') + '"'
+
+def connect_readonly(db_path):
+    """Open a read-only sqlite3 connection so queries cannot modify the stored upload"""
+    uri = pathlib.Path(db_path).as_uri() + '?mode=ro'
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+class SharedConnection:
+    """sqlite3 connection shared across sessions and the lock serializing its use"""
+    
+    def __init__(self, db_path):
+        self.conn = connect_readonly(db_path)
+        self.lock = threading.Lock()
+        # Close the connection once evicted from the cache, or at interpreter exit
+        weakref.finalize(self, self.conn.close)
+
+@st.cache_resource(max_entries=4)
+def _shared_conn(db_path):
+    """Shared connection for a database file, opened once per process"""
+    return SharedConnection(db_path)
+
+@contextmanager
+def get_conn(db_path):
+    """Use the shared connection for db_path exclusively for the duration of the block"""
+    shared = _shared_conn(db_path)
+    with shared.lock:
+        yield shared.conn
+
+class SharedEngine:
+    """Read-only SQLAlchemy engine shared across sessions"""
+    
+    def __init__(self, db_path):
+        self.engine = create_engine('sqlite://', creator=lambda: connect_readonly(db_path))
+        # Dispose pooled connections once evicted from the cache, or at interpreter exit
+        weakref.finalize(self, self.engine.dispose)
+
+@st.cache_resource(max_entries=4)
+def _shared_engine(db_path):
+    """Shared engine for a database file, created once per process"""
+    return SharedEngine(db_path)
+
+def get_engine(db_path):
+    """Shared read-only SQLAlchemy engine for the agent's SQL tools"""
+    return _shared_engine(db_path).engine
+
+def count_rows(cursor, table_name):
+    """Estimate one table's row count, falling back to COUNT(*) when it has no rowid"""
+    try:
+        cursor.execute(f"SELECT MAX(_rowid_) FROM {quote_identifier(table_name)}")
+    except sqlite3.Error:
+        cursor.execute(f"SELECT COUNT(*) FROM {quote_identifier(table_name)}")
+    return cursor.fetchone()[0]
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def explore_database(db_path, db_hash=None):
+    """Function to explore database structure (cached per file content via db_hash)"""
+    with get_conn(db_path) as conn:
+        return _explore_database(conn)
 
-def explore_database(db_path):
-    """Function to explore database structure"""
-    conn = sqlite3.connect(db_path)
+def _explore_database(conn):
+    """Read tables, columns and row-count estimates through an open connection"""
     cursor = conn.cursor()
     
-    # Get all table names
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
+    # Get all tables and their columns in a single query
+    cursor.execute("""
+        SELECT m.name, m.sql, p.cid, p.name, p.type, p."notnull", p.dflt_value, p.pk
+        FROM sqlite_master m JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table'
+        ORDER BY m.rowid, p.cid
+    """)
     
     table_info = {}
-    for table in tables:
-        table_name = table[0]
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = cursor.fetchall()
-        
-        cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-        row_count = cursor.fetchone()[0]
-        
-        table_info[table_name] = {
-            'columns': columns,
-            'row_count': row_count
-        }
+    without_rowid = set()
+    for table_name, sql, *column in cursor.fetchall():
+        if table_name not in table_info:
+            table_info[table_name] = {'columns': [], 'row_count': 0}
+            if sql and WITHOUT_ROWID.search(sql):
+                without_rowid.add(table_name)
+        table_info[table_name]['columns'].append(tuple(column))
     
-    conn.close()
+    # Estimate row counts with as few queries as the compound SELECT limit allows:
+    # MAX(rowid) is an index lookup, while WITHOUT ROWID tables have no rowid and
+    # fall back to COUNT(*)
+    table_names = list(table_info)
+    for start in range(0, len(table_names), MAX_COMPOUND_SELECT):
+        batch = table_names[start:start + MAX_COMPOUND_SELECT]
+        counts = " UNION ALL ".join(
+            f"SELECT ?, {'COUNT(*)' if name in without_rowid else 'MAX(_rowid_)'} FROM {quote_identifier(name)}"
+            for name in batch
+        )
+        try:
+            cursor.execute(counts, batch)
+            rows = cursor.fetchall()
+        except sqlite3.Error:
+            # A table the DDL check missed has no rowid; count that batch table by table
+            rows = [(name, count_rows(cursor, name)) for name in batch]
+        for table_name, row_count in rows:
+            table_info[table_name]['row_count'] = row_count or 0
+    
+    cursor.close()
     return table_info
 
-def preview_table(db_path, table_name, limit=5):
+@st.cache_data(max_entries=32, show_spinner=False)
+def preview_table(db_path, table_name, limit=5, db_hash=None):
     """Function to preview table data"""
-    conn = sqlite3.connect(db_path)
-    df = pd.read_sql_query(f"SELECT * FROM {table_name} LIMIT {limit}", conn)
-    conn.close()
-    return df
+    # Only allow tables that exist in the explored schema; checked before taking the
+    # connection lock so no cached function ever runs while that lock is held
+    if table_name not in explore_database(db_path, db_hash):
+        raise ValueError(f"Unknown table: {table_name}")
+    
+    with get_conn(db_path) as conn:
+        return pd.read_sql_query(f"SELECT * FROM {quote_identifier(table_name)} LIMIT ?", conn, params=(limit,))
+
+def build_batch_prompt(prompts):
+    """Combine queued questions into one numbered prompt for a single agent run"""
+    if len(prompts) == 1:
+        return prompts[0]
+    
+    questions = "\n".join(f"{i}) {prompt}" for i, prompt in enumerate(prompts, 1))
+    return (
+        f"Answer each of the following {len(prompts)} questions in order.\n"
+        f"Separate consecutive answers with a line containing exactly: {BATCH_DELIMITER}\n\n"
+        f"{questions}"
+    )
+
+def split_batch_response(text, prompts):
+    """Split a batched response into one chat message per question"""
+    if len(prompts) == 1:
+        return [text]
+    
+    answers = [answer.strip() for answer in text.split(BATCH_DELIMITER)]
+    if len(answers) != len(prompts):
+        # The model did not follow the delimiter format; keep the response whole
+        return [text]
+    return [f"**{prompt}**\n\n{answer}" for prompt, answer in zip(prompts, answers)]
+
+def add_message(role, content):
+    """Append a chat message, keeping only the last MAX_TURNS turns"""
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state.messages = st.session_state.messages[-MAX_TURNS * 2:]
+
+def _remove_files(paths):
+    """Delete the given files, ignoring ones that are already gone"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+@st.cache_resource
+def saved_db_paths():
+    """Database files written by this process, removed again on exit"""
+    paths = set()
+    atexit.register(_remove_files, paths)
+    return paths
+
+def save_uploaded_db(uploaded_file, db_hash):
+    """Persist an uploaded database to a stable path derived from its content hash"""
+    db_path = os.path.join(tempfile.gettempdir(), f"ttdb_{db_hash}.sqlite")
+    if not os.path.exists(db_path):
+        # Write to a temporary file and move it into place so readers never see a partial file
+        tmp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(db_path), prefix=f"ttdb_{db_hash}.", suffix='.part', delete=False)
+        try:
+            with tmp_file:
+                tmp_file.write(uploaded_file.getbuffer())
+            os.replace(tmp_file.name, db_path)
+        except BaseException:
+            _remove_files([tmp_file.name])
+            raise
+        saved_db_paths().add(db_path)
+    return db_path
+
+@st.fragment
+def render_table(db_path, db_hash, table_name, info):
+    """Render one table's expander; its Preview button only reruns this fragment"""
+    with st.expander(f"📊 {table_name} (~{info['row_count']} rows)"):
+        st.write("**Columns:**")
+        col_df = pd.DataFrame(info['columns'], 
+                            columns=['Column ID', 'Name', 'Type', 'Not Null', 'Default', 'Primary Key'])
+        st.dataframe(col_df[['Name', 'Type', 'Not Null', 'Primary Key']], width='stretch')
+        
+        # Load the preview lazily on first click and keep it shown on later reruns
+        show_key = f"show_preview_{db_hash}_{table_name}"
+        if st.button(f"Preview {table_name}", key=f"preview_{table_name}"):
+            st.session_state[show_key] = True
+        
+        if st.session_state.get(show_key):
+            # Fragment reruns bypass the error handling in main(), so report errors here
+            try:
+                preview_df = preview_table(db_path, table_name, db_hash=db_hash)
+                st.dataframe(preview_df, width='stretch')
+            except Exception as e:
+                st.error(f"Error previewing table: {str(e)}")
+
+def render_chat_history():
+    """Render the stored chat messages"""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
 # Main app
 def main():
@@ -130,34 +364,47 @@ def main():
         )
         
         if uploaded_file is not None:
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.sqlite') as tmp_file:
-                tmp_file.write(uploaded_file.read())
-                db_path = tmp_file.name
+            # Hash and save only when the uploader holds a new file; reruns from other
+            # widgets reuse the stored hash and path
+            if st.session_state.get('last_upload_id') != uploaded_file.file_id:
+                # Hash the file content so cached schema survives reruns but not new uploads
+                upload_hash = hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest()
+                
+                # Saving is a no-op when the hashed path already exists
+                st.session_state.db_path = save_uploaded_db(uploaded_file, upload_hash)
+                st.session_state.db_hash = upload_hash
+                st.session_state.last_upload_id = uploaded_file.file_id
+            db_hash = st.session_state.db_hash
+            db_path = st.session_state.db_path
             
             st.success(f"✅ Database '{uploaded_file.name}' loaded successfully!")
             
-            # Store db_path in session state
-            st.session_state.db_path = db_path
+            # Store db_name in session state
             st.session_state.db_name = uploaded_file.name
             
             # Database exploration
             st.header("🔍 Database Structure")
             try:
-                table_info = explore_database(db_path)
+                table_info = explore_database(db_path, db_hash)
+                
+                # Memoize derived schema context for the chat turns; an unchanged
+                # hash skips the rebuild and keeps this session's agent
+                if st.session_state.get('context_hash') != db_hash:
+                    st.session_state.context_hash = db_hash
+                    st.session_state.table_names = list(table_info.keys())
+                    st.session_state.system_message = build_system_message(table_info)
+                    st.session_state.agent = build_agent(db_path, st.session_state.system_message)
+                    
+                    # Questions queued for the previous database are not carried over
+                    st.session_state.pending_prompts = []
                 
                 for table_name, info in table_info.items():
-                    with st.expander(f"📊 {table_name} ({info['row_count']} rows)"):
-                        st.write("**Columns:**")
-                        col_df = pd.DataFrame(info['columns'], 
-                                            columns=['Column ID', 'Name', 'Type', 'Not Null', 'Default', 'Primary Key'])
-                        st.dataframe(col_df[['Name', 'Type', 'Not Null', 'Primary Key']], width='stretch')
-                        
-                        if st.button(f"Preview {table_name}", key=f"preview_{table_name}"):
-                            preview_df = preview_table(db_path, table_name)
-                            st.dataframe(preview_df, width='stretch')
+                    render_table(db_path, db_hash, table_name, info)
             
             except Exception as e:
+                # Drop schema context from a previous database so chat does not query it
+                for key in ('context_hash', 'table_names', 'system_message', 'agent'):
+                    st.session_state.pop(key, None)
                 st.error(f"Error exploring database: {str(e)}")
     
     # Main content area
@@ -168,52 +415,78 @@ def main():
         # Initialize chat history
         if "messages" not in st.session_state:
             st.session_state.messages = []
+        if "pending_prompts" not in st.session_state:
+            st.session_state.pending_prompts = []
         
         # Display chat messages
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        render_chat_history()
         
         # Chat input
         if prompt := st.chat_input("Ask a question about your database..."):
             # Add user message to chat history
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            add_message("user", prompt)
             with st.chat_message("user"):
                 st.markdown(prompt)
             
+            # Queue the question; ones whose run was interrupted by a newer
+            # submission are still pending and get answered in the same run
+            pending = st.session_state.pending_prompts
+            pending.append(prompt)
+            
             # Get agent response
             with st.chat_message("assistant"):
-                with st.spinner("Analyzing your query..."):
-                    try:
-                        if not groq_api_key:
-                            st.error("❌ GROQ_API_KEY not found. Please set your API key in the environment variables.")
-                            response = "Please configure your GROQ API key to use this feature."
-                        else:
-                            # Show available tables for context
-                            try:
-                                table_info = explore_database(st.session_state.db_path)
-                                table_names = list(table_info.keys())
-                                st.info(f"📊 Available tables: {', '.join(table_names)}")
-                            except:
-                                pass
-                            
-                            response = get_agent_response(prompt, st.session_state.db_path)
-                            
+                try:
+                    if not groq_api_key:
+                        st.error("❌ GROQ_API_KEY not found. Please set your API key in the environment variables.")
+                        response = "Please configure your GROQ API key to use this feature."
                         st.markdown(response)
+                        pending.clear()
                         
                         # Add assistant response to chat history
-                        st.session_state.messages.append({"role": "assistant", "content": response})
+                        add_message("assistant", response)
+                    else:
+                        # Show available tables for context
+                        table_names = st.session_state.get('table_names')
+                        if table_names is not None:
+                            st.info(f"📊 Available tables: {', '.join(table_names)}")
                         
-                    except Exception as e:
-                        error_msg = f"❌ Error processing query: {str(e)}"
-                        st.error(error_msg)
-                        st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                        agent = st.session_state.get('agent')
+                        if agent is None:
+                            with st.spinner("Analyzing your query..."):
+                                system_message = st.session_state.get('system_message')
+                                if system_message is None:
+                                    system_message = build_system_message(explore_database(st.session_state.db_path))
+                                agent = build_agent(st.session_state.db_path, system_message)
+                                st.session_state.agent = agent
+                        
+                        while pending:
+                            batch = pending[:MAX_BATCH_SIZE]
+                            
+                            # Render deltas as plain text as they arrive, then clean the full text once
+                            placeholder, streamed = render_stream(stream_agent_response(build_batch_prompt(batch), agent))
+                            response = clean_response(streamed)
+                            del pending[:len(batch)]
+                            
+                            # Swap to full markdown once the stream has settled
+                            answers = split_batch_response(response, batch)
+                            placeholder.markdown("\n\n---\n\n".join(answers))
+                            
+                            # Add assistant response to chat history
+                            for answer in answers:
+                                add_message("assistant", answer)
+                    
+                except Exception as e:
+                    error_msg = f"❌ Error processing query: {str(e)}"
+                    st.error(error_msg)
+                    pending.clear()
+                    add_message("assistant", error_msg)
         
         # Clear chat button
         col1, col2, col3 = st.columns([1, 1, 1])
         with col2:
             if st.button("🗑️ Clear Chat History", width='stretch'):
                 st.session_state.messages = []
+                st.session_state.pending_prompts = []
                 st.rerun()
     
     else: